@@ -2,37 +2,235 @@
 # github_java_bug_collector.py
 """
 抓取 GitHub 上 Java 项目（按 star 排序）自 cutoff_date 之后的 bug issues，
-并尝试找到对应修复的 commit（或 PR 合并产生的 commit），导出 JSON 与 CSV，
+并尝试找到对应修复的 commit（或 PR 合并产生的 commit），导出 JSONL 与 CSV，
 并对 commit 做两个“可运行性”近似检查：
   A) 该 commit 下存在构建文件（pom.xml / build.gradle / build.gradle.kts / settings.gradle）
   B) 该 commit 在 GitHub 上的 checks/status 为成功（若可查询）
 
-依赖: requests, python-dateutil, tqdm, pandas（可选）
-    pip install requests python-dateutil tqdm pandas
+依赖: requests, python-dateutil, tqdm, pandas（可选）, orjson（可选，加速 JSON 解析/序列化）,
+      pyarrow（可选，--out-format parquet 时需要）
+    pip install requests python-dateutil tqdm pandas orjson pyarrow
 用法示例:
     export GITHUB_TOKEN="ghp_xxx"
-    python github_java_bug_collector.py --out-json out.json --out-csv out.csv
+    # 或使用多个 token 轮换以提高速率限额：export GITHUB_TOKENS="ghp_a,ghp_b"
+    python github_java_bug_collector.py --out-json out.jsonl --out-csv out.csv
+    # 中断后继续（跳过 out.jsonl 中已有的 issue，追加写入）
+    python github_java_bug_collector.py --out-json out.jsonl --out-csv out.csv --resume
 
 在 Jupyter 中也可直接运行（脚本使用 parse_known_args）。
 """
-import os, sys, time, argparse, requests, json, csv, math
-from datetime import datetime, date
+import os, io, sys, re, time, argparse, requests, json, csv, math, threading, itertools, sqlite3, functools
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime, date, timedelta, timezone
 from dateutil import parser as dateparser
-from urllib.parse import quote_plus
+from urllib.parse import quote_plus, urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from time import monotonic
 from tqdm import tqdm
+try:
+    import orjson
+except ImportError:   # 可选依赖：未安装时回退到标准库 json
+    orjson = None
 
 # -------------------- 配置（可通过命令行覆盖） --------------------
 GITHUB_API = "https://api.github.com"
 DEFAULT_CUTOFF = "2025-01-22"   # 保守使用 DeepSeek-V3 发布后日期（可修改）
 MAX_REPOS = 200                 # 抓取 top N 仓库（按 stars）
 REPOS_PER_PAGE = 50
+SEARCH_RESULT_CAP = 1000        # GitHub search 单个查询最多返回 1000 条结果
+REPO_SEARCH_START = "2008-01-01"  # 仓库 created 时间切片的起点（GitHub 上线时间）
 MAX_ISSUES_PER_REPO = 50
+# issue 搜索条件：只要已关闭且关联了 PR 的 bug issue（服务端过滤掉没有修复的 issue）
+DEFAULT_ISSUE_QUERY = "is:issue is:closed label:bug linked:pr"
 MAX_COMMITS_PER_ISSUE = 5       # 对于每个 issue 最多采集多少 commit / PR
-SLEEP_BETWEEN_REQUESTS = 0.25   # 防速率限制
+MAX_PATCH_BYTES = 64 * 1024     # 单条 record 中 patch 的最大字节数（超出截断，0 表示不限制）
+COMMIT_CACHE_SIZE = 1024        # 进程内 (repo, sha) 级 commit 查询结果缓存的条目上限
+INDEX_MAX_PAGES = 50            # 建立 issue -> commit 索引时，PR / commit 列表各最多翻多少页
+MAX_PAGE_SIZE_RETRIES = 3       # 5xx / 超时后降低 per_page 重试的最大次数
+PAGE_SIZE_STEP = 20             # 每次降低的 per_page
+PAGE_SIZE_FLOOR = 25            # per_page 下限
+MAX_WORKERS = 8                 # 并发处理 issue / commit 的线程数（I/O 密集，可用 --workers 覆盖）
+MAX_RATE_LIMIT_RETRIES = 3      # 403/429 速率限制后的最大重试次数
+GRAPHQL_BATCH_SIZE = 50         # 单个 GraphQL 请求中最多查询的 commit 数（节点数限制）
+DEFAULT_CACHE_PATH = ".gh_cache.sqlite"   # ETag 条件请求缓存（304 不计入速率限制），--cache 不带路径时使用
+CACHE_MAX_AGE_DAYS = 7          # 打开缓存时删除超过该天数的条目，避免 sqlite 文件无限增长
+BUILD_FILES = ("pom.xml", "build.gradle", "build.gradle.kts", "settings.gradle")
 # -----------------------------------------------------------------
 
+# 各分页接口当前使用的 per_page：重负载查询反复 502/504 或超时时自动下调（见 api_get）
+PAGE_SIZE = {
+    "/search/issues": 100,
+    "/search/repositories": REPOS_PER_PAGE,
+    "/repos/*/commits": 100,
+    "/repos/*/pulls": 100,
+}
+_page_size_lock = threading.Lock()
+
+def page_size_key(url):
+    """返回 url 对应的 PAGE_SIZE 键；不可调的接口返回 None"""
+    parts = urlparse(url).path.strip("/").split("/")
+    if parts[0] == "search":
+        key = "/" + "/".join(parts[:2])
+    elif parts[0] == "repos" and len(parts) == 4:
+        key = f"/repos/*/{parts[3]}"
+    else:
+        return None
+    return key if key in PAGE_SIZE else None
+
+def json_loads(data):
+    """解析 JSON（bytes 或 str）；优先使用 orjson"""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+def json_dumps_bytes(obj):
+    """序列化为 UTF-8 JSON bytes（不转义非 ASCII）；优先使用 orjson"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+class TokenBucket:
+    """
+    线程安全的令牌桶限流器：桶容量 capacity，每秒补充 rate 个令牌。
+    acquire() 在令牌不足时阻塞，直到补充足够为止。
+    """
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        # updated 可能被 drain() 设置在未来：在此之前不补充令牌
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self, n=1):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self._refill(now)
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = max(self.updated - now, 0) + (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def available(self):
+        with self.lock:
+            self._refill(monotonic())
+            return self.tokens
+
+    def ready_in(self, n=1):
+        """还需等待多少秒才有 n 个令牌（已足够时为 0），与 acquire 的等待时间计算一致"""
+        with self.lock:
+            now = monotonic()
+            self._refill(now)
+            if self.tokens >= n:
+                return 0
+            return max(self.updated - now, 0) + (n - self.tokens) / self.rate
+
+    def release(self, n=1):
+        """归还令牌（请求未实际消耗额度时，例如 304 Not Modified）"""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + n)
+
+    def drain(self, seconds):
+        """清空令牌，且 seconds 秒内不再补充（服务端报告额度已耗尽时使用）"""
+        with self.lock:
+            self.tokens = 0
+            self.updated = max(self.updated, monotonic() + seconds)
+
+# GitHub 限额（每个 token 独立计算）：search 30 次/分钟，core 5000 次/小时；
+# graphql 按点数计 5000/小时（简单查询约 1 点/次）；未认证请求按 IP 计算：
+# search 10 次/分钟，core 60 次/小时，且不能使用 graphql
+RATE_LIMITS = {
+    True:  {"search": (30, 30 / 60), "core": (5000, 5000 / 3600), "graphql": (5000, 5000 / 3600)},
+    False: {"search": (10, 10 / 60), "core": (60, 60 / 3600)},
+}
+
+# token -> {"search": TokenBucket, "core": TokenBucket}；None 表示未认证
+TOKEN_BUCKETS = {}
+_token_lock = threading.Lock()
+_token_rr = itertools.count()
+
+def parse_tokens(token=None):
+    """
+    解析可用 token 列表：--token（可逗号分隔）> GITHUB_TOKENS（逗号分隔）> GITHUB_TOKEN。
+    都没有时返回 [None]（未认证）
+    """
+    raw = token or os.getenv("GITHUB_TOKENS") or os.getenv("GITHUB_TOKEN") or ""
+    tokens = [t.strip() for t in raw.split(",") if t.strip()]
+    return tokens or [None]
+
+def _new_buckets(token):
+    limits = RATE_LIMITS[token is not None]
+    return {kind: TokenBucket(cap, rate) for kind, (cap, rate) in limits.items()}
+
+def init_token_pool(tokens):
+    with _token_lock:
+        TOKEN_BUCKETS.clear()
+        for t in tokens:
+            TOKEN_BUCKETS[t] = _new_buckets(t)
+
+def _ensure_pool():
+    # 调用方需持有 _token_lock；未调用 init_token_pool 时按环境变量初始化
+    if not TOKEN_BUCKETS:
+        for t in parse_tokens():
+            TOKEN_BUCKETS[t] = _new_buckets(t)
+
+def buckets_for(token):
+    with _token_lock:
+        _ensure_pool()
+        if token not in TOKEN_BUCKETS:
+            TOKEN_BUCKETS[token] = _new_buckets(token)
+        return TOKEN_BUCKETS[token]
+
+def pick_token(kind):
+    """
+    返回 kind（search/core）桶中剩余令牌最多的 token；全部耗尽时返回最早恢复的 token，
+    完全相同时按 round-robin 轮换
+    """
+    with _token_lock:
+        _ensure_pool()
+        tokens = [t for t, b in TOKEN_BUCKETS.items() if kind in b]
+    if not tokens:
+        raise RuntimeError(f"no GitHub token available for {kind} requests")
+    start = next(_token_rr) % len(tokens)
+    rotated = tokens[start:] + tokens[:start]
+    # max 在相等时返回第一个，因此轮换起点即实现平局时的 round-robin
+    def score(t):
+        b = TOKEN_BUCKETS[t][kind]
+        return -b.ready_in(), b.available()
+    return max(rotated, key=score)
+
+def has_auth_token():
+    with _token_lock:
+        _ensure_pool()
+        return any(t is not None for t in TOKEN_BUCKETS)
+
+def endpoint_kind(url):
+    if url.endswith("/graphql"):
+        return "graphql"
+    return "search" if "/search/" in url else "core"
+
+def _new_session():
+    # 全程复用同一个 Session：keep-alive 复用到 api.github.com 的 TCP/TLS 连接，
+    # 连接池大小覆盖所有工作线程；5xx 由 urllib3 自动退避重试（GraphQL 查询也是幂等的，
+    # 因此 POST 同样重试），重试耗尽后返回最后的响应交给 raise_for_status 处理
+    session = requests.Session()
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504],
+                  allowed_methods=None, respect_retry_after_header=True, raise_on_status=False)
+    session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry))
+    return session
+
+SESSION = _new_session()
+
 def get_headers(token=None, extra_accept=None):
-    h = {"Accept": "application/vnd.github+json"}
+    h = {"Accept": "application/vnd.github+json", "Accept-Encoding": "gzip"}
     if extra_accept:
         # e.g. for commit search: 'application/vnd.github.cloak-preview+json'
         h["Accept"] = extra_accept
@@ -41,52 +239,279 @@ def get_headers(token=None, extra_accept=None):
         h["Authorization"] = f"token {t}"
     return h
 
-def api_get(url, params=None, token=None, extra_accept=None):
-    headers = get_headers(token, extra_accept)
-    r = requests.get(url, headers=headers, params=params, timeout=30)
-    if r.status_code == 403:
-        # 处理速率限制：尝试等待到 reset
+class EtagCache:
+    """
+    基于 sqlite 的 GET 响应持久缓存：key（完整 URL + Accept）-> (etag, body, headers)。
+    再次请求时带上 If-None-Match，命中 304 时直接返回缓存内容。线程安全。
+    """
+    def __init__(self, path, max_age_days=CACHE_MAX_AGE_DAYS):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS http_cache ("
+                          "key TEXT PRIMARY KEY, etag TEXT, body TEXT, headers TEXT, fetched_at REAL)")
+        # 过期条目直接删除（按 fetched_at），并回收空间
+        cur = self.conn.execute("DELETE FROM http_cache WHERE fetched_at < ?", (time.time() - max_age_days * 86400,))
+        if cur.rowcount > 0:
+            self.conn.execute("VACUUM")
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT etag, body, headers FROM http_cache WHERE key = ?", (key,)).fetchone()
+        return row
+
+    def put(self, key, etag, body, headers):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?)",
+                              (key, etag, body, json.dumps(dict(headers)), time.time()))
+
+HTTP_CACHE = None   # 由 init_http_cache() 设置；None 表示不使用缓存
+
+def init_http_cache(path):
+    global HTTP_CACHE
+    HTTP_CACHE = EtagCache(path) if path else None
+
+def _request(method, url, token=None, extra_accept=None, extra_headers=None, **kwargs):
+    """
+    发送请求并返回 Response。未指定 token 时从 token 池中挑选剩余额度最多的 token；
+    某个 token 额度耗尽时标记其令牌桶直到 reset，并立即换下一个 token 重试。
+    """
+    kind = endpoint_kind(url)
+    for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+        t = token if token is not None else pick_token(kind)
+        bucket = buckets_for(t)[kind]
+        bucket.acquire()
+        headers = get_headers(t, extra_accept)
+        if extra_headers:
+            headers.update(extra_headers)
+        r = SESSION.request(method, url, headers=headers, timeout=30, **kwargs)
+        if r.status_code == 304:
+            # 条件请求命中：GitHub 不计入速率限制，归还令牌
+            bucket.release()
+        if r.status_code not in (403, 429) or attempt == MAX_RATE_LIMIT_RETRIES:
+            break
+        retry_after = r.headers.get("Retry-After")
         reset = r.headers.get("X-RateLimit-Reset")
-        if reset:
-            wait = int(reset) - int(time.time()) + 3
-            wait = max(wait, 5)
-            print(f"[rate-limit] waiting {wait}s...")
+        if retry_after:
+            # secondary rate limit：按服务端给出的秒数等待
+            wait = max(int(retry_after), 1)
+            print(f"[rate-limit] secondary limit, waiting {wait}s...")
             time.sleep(wait)
-            r = requests.get(url, headers=headers, params=params, timeout=30)
+        elif reset and r.headers.get("X-RateLimit-Remaining") == "0":
+            # 该 token 额度耗尽：清空其令牌桶直到 reset；下一轮会优先选择其他 token，
+            # 若全部耗尽，pick_token 选择最早恢复的那个，acquire 只等待它恢复
+            wait = max(int(reset) - int(time.time()) + 3, 5)
+            print(f"[rate-limit] token quota exhausted for {wait}s, switching token...")
+            bucket.drain(wait)
+        else:
+            # 非速率限制导致的 403/429（如权限不足）
+            break
     r.raise_for_status()
-    time.sleep(SLEEP_BETWEEN_REQUESTS)
-    return r.json(), r.headers
-
-def search_repos_language_java(per_page=REPOS_PER_PAGE, max_repos=MAX_REPOS, token=None):
-    repos = []
-    page = 1
-    while len(repos) < max_repos:
-        params = {"q": "language:Java", "sort": "stars", "order": "desc", "per_page": per_page, "page": page}
-        data, headers = api_get(f"{GITHUB_API}/search/repositories", params=params, token=token)
-        items = data.get("items", [])
-        if not items:
+    return r
+
+def api_get(url, params=None, token=None, extra_accept=None):
+    """
+    GET 并返回 (json, headers)。分页接口遇到 502/503/504 或超时（已经过 Session 层重试）时，
+    下调该接口的 PAGE_SIZE 并退避重试：第一页直接以新的 per_page 重试；后续页（Link 中已固定
+    per_page / page）保持原参数重试以免错位，新的 per_page 从下一次查询开始生效
+    """
+    key = page_size_key(url)
+    for attempt in range(MAX_PAGE_SIZE_RETRIES + 1):
+        try:
+            return _api_get_once(url, params, token, extra_accept)
+        except (requests.HTTPError, requests.ConnectionError, requests.Timeout) as e:
+            status = e.response.status_code if e.response is not None else None
+            transient = status in (502, 503, 504) or not isinstance(e, requests.HTTPError)
+            if key is None or not transient or attempt == MAX_PAGE_SIZE_RETRIES:
+                raise
+            with _page_size_lock:
+                PAGE_SIZE[key] = max(PAGE_SIZE[key] - PAGE_SIZE_STEP, PAGE_SIZE_FLOOR)
+                size = PAGE_SIZE[key]
+            if params and "per_page" in params and str(params.get("page", 1)) == "1":
+                params = {**params, "per_page": min(params["per_page"], size)}
+            print(f"[page-size] {key} -> per_page={size} after {status or type(e).__name__}, retrying...")
+            time.sleep(2 ** attempt)
+
+def _api_get_once(url, params=None, token=None, extra_accept=None):
+    cache = HTTP_CACHE
+    if cache is None:
+        r = _request("GET", url, token=token, extra_accept=extra_accept, params=params)
+        return json_loads(r.content), r.headers
+    key = requests.Request("GET", url, params=params).prepare().url + "|" + (extra_accept or "")
+    cached = cache.get(key)
+    extra_headers = {"If-None-Match": cached[0]} if cached and cached[0] else None
+    r = _request("GET", url, token=token, extra_accept=extra_accept, extra_headers=extra_headers, params=params)
+    if r.status_code == 304 and cached:
+        return json_loads(cached[1]), requests.structures.CaseInsensitiveDict(json_loads(cached[2]))
+    etag = r.headers.get("ETag")
+    if etag:
+        cache.put(key, etag, r.content, r.headers)
+    return json_loads(r.content), r.headers
+
+def graphql_post(query, variables=None, token=None):
+    """POST 到 GraphQL v4 接口，返回 data；整个查询失败（无 data）时抛出 RuntimeError"""
+    r = _request("POST", f"{GITHUB_API}/graphql", token=token, json={"query": query, "variables": variables or {}})
+    body = json_loads(r.content)
+    if body.get("data") is None:
+        raise RuntimeError(f"graphql error: {body.get('errors')}")
+    return body["data"]
+
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=16)   # 分页接口预取下一页（多个仓库并行翻页时共用）
+
+def _next_link(headers):
+    for link in requests.utils.parse_header_links(headers.get("Link", "")):
+        if link.get("rel") == "next":
+            return link.get("url")
+    return None
+
+def iter_pages(url, params=None, token=None, max_items=None, first=None):
+    """
+    沿 Link: rel="next" 逐页返回 (data, headers)。每拿到一页，先提交下一页的请求再把当前页交给调用方
+    （流水线预取）；已取到 max_items 条时不再预取，避免浪费 search 限额。
+    first 为调用方已获取的第一页 (data, headers)（可选）。
+    """
+    if first is not None:
+        fut = Future()
+        fut.set_result(first)
+    else:
+        fut = PREFETCH_EXECUTOR.submit(api_get, url, params, token)
+    inflight = deque([fut])
+    seen = 0
+    while inflight:
+        data, headers = inflight.popleft().result()
+        items = data.get("items", []) if isinstance(data, dict) else data
+        seen += len(items)
+        nxt = _next_link(headers)
+        if nxt and items and (max_items is None or seen < max_items):
+            inflight.append(PREFETCH_EXECUTOR.submit(api_get, nxt, None, token))
+        yield data, headers
+
+def _fmt_created(dt):
+    return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _search_repos_top(q, per_page, want, token=None):
+    """按 stars 降序取查询 q 的前 want 条（want <= SEARCH_RESULT_CAP），返回 (items, total_count)"""
+    url = f"{GITHUB_API}/search/repositories"
+    params = {"q": q, "sort": "stars", "order": "desc", "per_page": per_page}
+    items, total = [], 0
+    for data, _ in iter_pages(url, params, token=token, max_items=want):
+        total = data.get("total_count", 0)
+        items.extend(data.get("items", []))
+        if len(items) >= want:
             break
-        repos.extend(items)
-        if len(items) < per_page:
+    return items[:want], total
+
+def _search_repos_slice(qualifier, start, end, per_page, limit, out, token=None):
+    """
+    抓取满足 qualifier 且 created 在 [start, end] 内的 Java 仓库写入 out（按 repo id 去重），直到 out 达到 limit。
+    若该切片总数超过 SEARCH_RESULT_CAP，则二分时间区间递归（最小到一分钟）。out 中可能已有这一档的部分仓库，
+    翻页时它们只是重复，因此按 out 的实际大小判断是否取够，而不是按本切片返回的条数。
+    只用于 stars 完全相同的一档仓库（见 search_repos_language_java），因此先取哪个时间段都不影响排序
+    """
+    url = f"{GITHUB_API}/search/repositories"
+    q = f"language:Java {qualifier} created:{_fmt_created(start)}..{_fmt_created(end)}"
+    params = {"q": q, "sort": "stars", "order": "desc", "per_page": per_page}
+    first = api_get(url, params=params, token=token)
+    if first[0].get("total_count", 0) > SEARCH_RESULT_CAP and end - start > timedelta(minutes=1):
+        mid = start + (end - start) / 2
+        _search_repos_slice(qualifier, start, mid, per_page, limit, out, token=token)
+        if len(out) < limit:
+            _search_repos_slice(qualifier, mid + timedelta(seconds=1), end, per_page, limit, out, token=token)
+        return
+    for data, _ in iter_pages(url, token=token, first=first):
+        for it in data.get("items", []):
+            out.setdefault(it["id"], it)
+        if len(out) >= limit:
             break
-        page += 1
+
+def search_repos_language_java(per_page=None, max_repos=MAX_REPOS, token=None,
+                               start_date=None, end_date=None):
+    """
+    按 stars 降序抓取 created 在 [start_date, end_date] 内的 top max_repos 个 Java 仓库。
+    单个查询最多 1000 条，超过时按 stars 区间分段：每轮取 stars:<=upper 的前 1000 条，
+    其中 stars 高于本轮最低值 m 的仓库已完整取到，下一轮从 stars:<=m 继续（重复的按 id 去重）。
+    若某一 stars 值本身就超过 1000 个仓库，则按 created 时间切片收集这一档，再继续更低的 stars
+    """
+    per_page = per_page or PAGE_SIZE["/search/repositories"]
+    start = dateparser.parse(start_date or REPO_SEARCH_START).replace(tzinfo=timezone.utc)
+    end = dateparser.parse(end_date).replace(tzinfo=timezone.utc) if end_date else datetime.now(timezone.utc)
+    created = f"created:{_fmt_created(start)}..{_fmt_created(end)}"
+    out = {}
+    upper = None
+    while len(out) < max_repos and (upper is None or upper >= 0):
+        stars = f" stars:<={upper}" if upper is not None else ""
+        # stars == upper 的仓库上一轮可能已取到一部分，会在本轮结果中重复出现
+        dup = sum(1 for r in out.values() if r.get("stargazers_count") == upper) if upper is not None else 0
+        want = min(SEARCH_RESULT_CAP, max_repos - len(out) + dup)
+        items, total = _search_repos_top(f"language:Java {created}{stars}", per_page, want, token=token)
+        for it in items:
+            out.setdefault(it["id"], it)
+        if not items or len(items) >= total:
+            break   # 该 stars 区间已全部取完
+        lowest = items[-1].get("stargazers_count", 0)
+        if upper is not None and lowest >= upper:
+            # 超过 1000 个仓库的 stars 都等于 upper：按时间切片收集这一档
+            _search_repos_slice(f"stars:{upper}", start, end, per_page, max_repos, out, token=token)
+            upper -= 1
+        else:
+            upper = lowest
+    repos = sorted(out.values(), key=lambda r: r.get("stargazers_count", 0), reverse=True)
     return repos[:max_repos]
 
-def search_issues_for_repo(repo_fullname, q_extra, per_page=100, max_issues=MAX_ISSUES_PER_REPO, token=None):
+def search_issues_for_repo(repo_fullname, q_extra, per_page=None, max_issues=MAX_ISSUES_PER_REPO, token=None):
     items = []
-    page = 1
-    while len(items) < max_issues:
-        q = f"repo:{repo_fullname} {q_extra}"
-        params = {"q": q, "per_page": per_page, "page": page}
-        data, headers = api_get(f"{GITHUB_API}/search/issues", params=params, token=token)
-        hits = data.get("items", [])
-        items.extend(hits)
-        if len(hits) < per_page:
+    per_page = per_page or PAGE_SIZE["/search/issues"]
+    params = {"q": f"repo:{repo_fullname} {q_extra}", "per_page": per_page}
+    # GitHub search API 有 1000 条限制 per single query - we assume per repo it's small
+    for data, _ in iter_pages(f"{GITHUB_API}/search/issues", params, token=token, max_items=max_issues):
+        items.extend(data.get("items", []))
+        if len(items) >= max_issues:
             break
-        page += 1
-        # GitHub search API 有 1000 条限制 per single query - we assume per repo it's small
     return items[:max_issues]
 
+# 匹配 "#123" 形式的 issue 引用（排除 "owner/repo#123" 这类跨仓库引用）
+ISSUE_REF_RE = re.compile(r"(?<![\w/])#(\d+)")
+
+def build_issue_commit_index(repo_fullname, since, token=None, max_results=MAX_COMMITS_PER_ISSUE):
+    """
+    一次性抓取仓库自 since 以来的 commits 与已合并 PR，在本地解析 "#N" 引用，
+    建立 {issue_number: [{"sha", "message", "url"}, ...]} 索引（与 find_commits_referencing_issue 的返回格式一致）。
+    全部走 core 限额的列表接口，替代每个 issue 两次的 search 请求。
+    """
+    since_iso = f"{since.isoformat()}T00:00:00Z"
+    index = {}
+
+    def add(text, entry):
+        for num in dict.fromkeys(int(m) for m in ISSUE_REF_RE.findall(text or "")):
+            refs = index.setdefault(num, [])
+            if len(refs) < max_results and all(r["sha"] != entry["sha"] for r in refs):
+                refs.append(entry)
+
+    # 1) 默认分支上 since 之后的 commits（commit message 中引用 issue）
+    url = f"{GITHUB_API}/repos/{repo_fullname}/commits"
+    per_page = PAGE_SIZE["/repos/*/commits"]
+    pages = iter_pages(url, {"since": since_iso, "per_page": per_page}, token=token,
+                       max_items=INDEX_MAX_PAGES * per_page)
+    for commits, _ in itertools.islice(pages, INDEX_MAX_PAGES):
+        for c in commits:
+            msg = c.get("commit", {}).get("message", "")
+            if c.get("sha"):
+                add(msg, {"sha": c["sha"], "message": msg, "url": c.get("url")})
+
+    # 2) 已合并的 PR（标题 / 描述中引用 issue），按更新时间倒序，早于 since 即停止
+    url = f"{GITHUB_API}/repos/{repo_fullname}/pulls"
+    per_page = PAGE_SIZE["/repos/*/pulls"]
+    params = {"state": "closed", "sort": "updated", "direction": "desc", "per_page": per_page}
+    pages = iter_pages(url, params, token=token, max_items=INDEX_MAX_PAGES * per_page)
+    for prs, _ in itertools.islice(pages, INDEX_MAX_PAGES):
+        for pr in prs:
+            if pr.get("merged_at") and pr.get("merge_commit_sha"):
+                add(f"{pr.get('title', '')}\n{pr.get('body') or ''}",
+                    {"sha": pr["merge_commit_sha"], "message": pr.get("title", ""), "url": pr.get("url")})
+        if prs and (prs[-1].get("updated_at") or "") < since_iso:
+            break
+    return index
+
 def find_commits_referencing_issue(repo_fullname, issue_number, token=None, max_results=MAX_COMMITS_PER_ISSUE):
     """
     使用 commit 搜索（需要特殊 Accept header）在 commit message 中搜索 issue number（例如 #123）
@@ -133,19 +558,82 @@ def find_commits_referencing_issue(repo_fullname, issue_number, token=None, max_
         except Exception:
             pass
 
-    # 去重并截断
-    seen = set()
-    out = []
+    # 按 sha 去重（保留首次出现的条目与顺序）并截断
+    uniq = {}
     for c in commits:
-        if not c.get("sha"):
-            continue
-        if c["sha"] in seen:
-            continue
-        seen.add(c["sha"])
-        out.append(c)
-        if len(out) >= max_results:
+        if c.get("sha"):
+            uniq.setdefault(c["sha"], c)
+    return list(uniq.values())[:max_results]
+
+def get_issue_timeline(repo_fullname, issue_number, token=None, max_results=MAX_COMMITS_PER_ISSUE):
+    """
+    通过 issue timeline（core 限额）找修复该 issue 的 commit，返回格式与 find_commits_referencing_issue 一致：
+      1) closed 事件中的 commit_id（由 commit 关闭 issue，最权威）
+      2) cross-referenced 中同仓库、已合并 PR 的 merge_commit_sha
+      3) referenced 事件中的 commit_id（commit message 提到了该 issue）
+    """
+    url = f"{GITHUB_API}/repos/{repo_fullname}/issues/{issue_number}/timeline"
+    params = {"per_page": 100}
+    events = []
+    while url:
+        data, headers = api_get(url, params=params, token=token)
+        events.extend(data)
+        url, params = _next_link(headers), None
+
+    closed, prs, referenced = [], [], []
+    pr_prefix = f"{GITHUB_API}/repos/{repo_fullname}/pulls/"
+    # 来自 fork 的 commit 引用 commit_url 指向 fork 仓库，不算本仓库的修复
+    commit_prefix = f"{GITHUB_API}/repos/{repo_fullname}/commits/".lower()
+    for ev in events:
+        kind = ev.get("event")
+        if (kind in ("closed", "referenced") and ev.get("commit_id")
+                and (ev.get("commit_url") or "").lower().startswith(commit_prefix)):
+            entry = {"sha": ev["commit_id"], "message": "", "url": ev.get("commit_url")}
+            (closed if kind == "closed" else referenced).append(entry)
+        elif kind == "cross-referenced":
+            pr = ((ev.get("source") or {}).get("issue") or {}).get("pull_request") or {}
+            if pr.get("merged_at") and (pr.get("url") or "").startswith(pr_prefix):
+                prs.append(pr["url"])
+    commits = closed
+    for pr_url in dict.fromkeys(prs):
+        if len(commits) >= max_results:
             break
-    return out
+        try:
+            pr_data, _ = api_get(pr_url, token=token)
+        except requests.RequestException:
+            # 单个 PR 获取失败只跳过该 PR，保留已取到的 timeline 结果
+            continue
+        if pr_data.get("merge_commit_sha"):
+            commits.append({"sha": pr_data["merge_commit_sha"], "message": pr_data.get("title", ""), "url": pr_url})
+    commits += referenced
+    # 按 sha 去重（保留首次出现的条目与顺序）并截断
+    uniq = {}
+    for c in commits:
+        uniq.setdefault(c["sha"], c)
+    return list(uniq.values())[:max_results]
+
+# (函数名, repo_fullname, sha) -> 结果的 LRU 缓存：同一个修复 commit 常被多个 issue 引用，
+# 只在第一次解析时请求。commit 按 sha 不可变，结果与所用 token 无关。
+# 只缓存体积小的结果（不缓存带 patch 的 commit 详情）；函数遇到临时错误时直接抛出，异常不会进入缓存
+COMMIT_CACHE = OrderedDict()
+NOT_FOUND_STATUSES = (404, 409, 422)   # commit 不存在 / 仓库为空等确定性的错误码，结果可以缓存
+_commit_cache_lock = threading.Lock()
+
+def _commit_cached(fn):
+    @functools.wraps(fn)
+    def wrapper(repo_fullname, sha, token=None):
+        key = (fn.__name__, repo_fullname, sha)
+        with _commit_cache_lock:
+            if key in COMMIT_CACHE:
+                COMMIT_CACHE.move_to_end(key)
+                return COMMIT_CACHE[key]
+        result = fn(repo_fullname, sha, token=token)
+        with _commit_cache_lock:
+            COMMIT_CACHE[key] = result
+            if len(COMMIT_CACHE) > COMMIT_CACHE_SIZE:
+                COMMIT_CACHE.popitem(last=False)
+        return result
+    return wrapper
 
 def get_commit_details(repo_fullname, sha, token=None):
     # 获取 commit 详情（包含 files[] 和 patch 字段）
@@ -153,43 +641,96 @@ def get_commit_details(repo_fullname, sha, token=None):
     data, _ = api_get(url, token=token)
     return data
 
+@_commit_cached
+def get_git_commit(repo_fullname, sha, token=None):
+    # 轻量的 git commit 对象（message / author / committer / tree / parents，不含 diff）
+    data, _ = api_get(f"{GITHUB_API}/repos/{repo_fullname}/git/commits/{sha}", token=token)
+    return data
+
+@_commit_cached
 def commit_has_build_file(repo_fullname, sha, token=None):
-    # 检查常见构建文件是否存在于该 commit 的根目录
-    candidates = ["pom.xml", "build.gradle", "build.gradle.kts", "settings.gradle", "pom.xml"]
-    for fname in candidates:
-        url = f"{GITHUB_API}/repos/{repo_fullname}/contents/{fname}"
-        try:
-            data, _ = api_get(url, params={"ref": sha}, token=token)
-            if data and data.get("type") == "file":
-                return True, fname
-        except requests.HTTPError as e:
-            # 404 等表示不存在，继续检查下一个
-            continue
+    # 检查常见构建文件是否存在于该 commit 的根目录：一次获取根 tree（非递归），在内存中判断
+    try:
+        data, _ = api_get(f"{GITHUB_API}/repos/{repo_fullname}/git/trees/{sha}", token=token)
+    except requests.HTTPError as e:
+        # 404/409/422（commit 不存在或仓库为空）是确定的结果；其他错误（5xx 等）继续抛出，不缓存
+        if e.response is not None and e.response.status_code in NOT_FOUND_STATUSES:
+            return False, None
+        raise
+    names = {e.get("path") for e in data.get("tree", []) if e.get("type") == "blob"}
+    for fname in BUILD_FILES:
+        if fname in names:
+            return True, fname
     return False, None
 
+@_commit_cached
 def commit_check_status_success(repo_fullname, sha, token=None):
-    # 尝试获取 combined status 或 check-runs 状态
-    try:
-        data, _ = api_get(f"{GITHUB_API}/repos/{repo_fullname}/commits/{sha}/status", token=token)
-        state = data.get("state")  # "success", "failure", "pending"
-        if state == "success":
-            return True, "status:success"
-    except Exception:
-        pass
-    # check-runs
+    # 一次获取该 commit 的全部 check suites（GitHub Actions 等 CI 都会产生 check suite），
+    # 至少一个 conclusion == success 即视为 success（这个判断可以更严格）
     try:
-        data, _ = api_get(f"{GITHUB_API}/repos/{repo_fullname}/commits/{sha}/check-runs", token=token,
-                         extra_accept="application/vnd.github+json")
-        runs = data.get("check_runs", [])
-        if runs:
-            # 若至少有一个已完成并且 conclusion == success，则视为 success（这个判断可以更严格）
-            for r in runs:
-                if r.get("status") == "completed" and r.get("conclusion") == "success":
-                    return True, f"check-run:{r.get('name')}"
-    except Exception:
-        pass
+        data, _ = api_get(f"{GITHUB_API}/repos/{repo_fullname}/commits/{sha}/check-suites", token=token)
+    except requests.HTTPError as e:
+        # 同 commit_has_build_file：只有 404/409/422 视为没有 checks，其他错误继续抛出，不缓存
+        if e.response is not None and e.response.status_code in NOT_FOUND_STATUSES:
+            return False, None
+        raise
+    for suite in data.get("check_suites", []):
+        if suite.get("conclusion") == "success":
+            return True, f"check-suite:{(suite.get('app') or {}).get('slug')}"
     return False, None
 
+COMMIT_GRAPHQL_FIELDS = """
+... on Commit {
+  oid
+  message
+  committedDate
+  statusCheckRollup { state }
+  tree { entries { name type } }
+}"""
+
+def fetch_commits_graphql(pairs, token=None):
+    """
+    用 GraphQL 批量获取 commit 元信息、根目录构建文件与 checks 汇总状态，
+    每个请求最多 GRAPHQL_BATCH_SIZE 个 commit（通过别名 r{i} / c{j} 组合子查询）。
+    pairs: [(repo_fullname, sha), ...]
+    返回 {(repo_fullname, sha): {"message", "date", "has_build", "build_name", "check_ok", "check_info"}}；
+    查询不到的 commit 不会出现在结果中。
+    """
+    out = {}
+    pairs = list(dict.fromkeys(pairs))
+    for i in range(0, len(pairs), GRAPHQL_BATCH_SIZE):
+        chunk = pairs[i:i + GRAPHQL_BATCH_SIZE]
+        by_repo = {}
+        for repo_fullname, sha in chunk:
+            by_repo.setdefault(repo_fullname, []).append(sha)
+        parts, aliases = [], {}
+        for ri, (repo_fullname, shas) in enumerate(by_repo.items()):
+            owner, name = repo_fullname.split("/", 1)
+            sub = []
+            for ci, sha in enumerate(shas):
+                sub.append(f"c{ci}: object(oid: {json.dumps(sha)}) {{{COMMIT_GRAPHQL_FIELDS}}}")
+                aliases[(f"r{ri}", f"c{ci}")] = (repo_fullname, sha)
+            parts.append(f"r{ri}: repository(owner: {json.dumps(owner)}, name: {json.dumps(name)}) {{ {' '.join(sub)} }}")
+        data = graphql_post("query { " + " ".join(parts) + " }", token=token)
+        for (ra, ca), key in aliases.items():
+            commit = (data.get(ra) or {}).get(ca)
+            if not commit:
+                continue
+            names = {e.get("name") for e in (commit.get("tree") or {}).get("entries", []) if e.get("type") == "blob"}
+            build_name = next((f for f in BUILD_FILES if f in names), None)
+            state = (commit.get("statusCheckRollup") or {}).get("state")
+            out[key] = {
+                "message": commit.get("message"),
+                "date": commit.get("committedDate"),
+                "has_build": build_name is not None,
+                "build_name": build_name,
+                "check_ok": state == "SUCCESS",
+                "check_info": f"rollup:{state.lower()}" if state else None,
+            }
+    return out
+
+COMMIT_EXECUTOR = None   # per-commit 请求线程池，由 main 按 --workers 创建；None 时串行执行
+
 def normalize_issue_item(issue, repo_fullname):
     return {
         "issue_id": issue.get("id"),
@@ -204,114 +745,392 @@ def normalize_issue_item(issue, repo_fullname):
         "user_login": (issue.get("user") or {}).get("login")
     }
 
-def save_json(data, path):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    print(f"[saved] {path}")
+# CSV 列顺序（patch 可能很长，仍会写入）
+FIELDNAMES = ["repo_fullname","repo_url","issue_id","issue_number","issue_title","issue_body","issue_created_at","issue_updated_at",
+              "issue_url","user_login","commit_sha","commit_message","commit_date","commit_has_build_file","commit_build_file_name",
+              "commit_check_success","commit_check_info","patch"]
+PARQUET_BATCH_ROWS = 500        # parquet 输出每个 row group 的行数
+
+class CsvTableWriter:
+    """
+    流式写 CSV / TSV。csv 为 QUOTE_ALL；tsv 不加引号，手工用制表符拼接各列，
+    每个文本列中的 \\、\\n、\\r、\\t 转义成两个字符（引号原样写出），None 写为空串
+    """
+    TSV_ESCAPES = str.maketrans({"\\": "\\\\", "\n": "\\n", "\r": "\\r", "\t": "\\t"})
+
+    def __init__(self, path, fmt="csv"):
+        self.tsv = fmt == "tsv"
+        self.f = open(path, "w", newline="", encoding="utf-8")
+        if self.tsv:
+            self.f.write("\t".join(FIELDNAMES) + "\n")
+        else:
+            self.w = csv.DictWriter(self.f, fieldnames=FIELDNAMES, quoting=csv.QUOTE_ALL)
+            self.w.writeheader()
+
+    def writerow(self, rec):
+        if self.tsv:
+            vals = ("" if rec.get(name) is None else str(rec[name]).translate(self.TSV_ESCAPES) for name in FIELDNAMES)
+            self.f.write("\t".join(vals) + "\n")
+        else:
+            self.w.writerow(rec)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class ParquetTableWriter:
+    """流式写 parquet：每攒够 PARQUET_BATCH_ROWS 行写一个 row group，列式 zstd 压缩"""
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        types = {"issue_id": pa.int64(), "issue_number": pa.int64(),
+                 "commit_has_build_file": pa.bool_(), "commit_check_success": pa.bool_()}
+        self.schema = pa.schema([(name, types.get(name, pa.string())) for name in FIELDNAMES])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self.rows = []
+
+    def writerow(self, rec):
+        self.rows.append({name: rec.get(name) for name in FIELDNAMES})
+
+    def flush(self, force=False):
+        if self.rows and (force or len(self.rows) >= PARQUET_BATCH_ROWS):
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush(force=True)
+        self.writer.close()
+
+def open_table_writer(path, fmt):
+    if fmt == "parquet":
+        return ParquetTableWriter(path)
+    return CsvTableWriter(path, fmt)
+
+def load_done_issues(path, table=None):
+    """
+    逐行读取已有的 JSONL 输出，返回已处理过的 {(repo_fullname, issue_number)}（用于 --resume）。
+    JSONL 是唯一的断点依据：若上次运行中断在半行，截掉末尾不完整的那一行，保证后续追加写入仍是合法 JSONL；
+    table 为新建的表格输出时，把已有 records 重新写入，使表格与 JSONL 一致（不追加可能已损坏的旧表格）。
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        good = 0   # 最后一个完整行之后的字节偏移
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            good += len(line)
+            try:
+                rec = json_loads(line)
+            except ValueError:
+                continue
+            done.add((rec.get("repo_fullname"), rec.get("issue_number")))
+            if table is not None:
+                table.writerow(rec)
+        f.truncate(good)
+    return done
+
+def probe_commit(full, sha, meta=None, token=None):
+    """
+    只检查构建文件与 CI/checks 状态（不取 patch），返回 (has_build, build_name, check_ok, check_info)；
+    meta 为 fetch_commits_graphql 的结果（可选），命中时不再发请求
+    """
+    m = (meta or {}).get((full, sha))
+    if m:
+        return m["has_build"], m["build_name"], m["check_ok"], m["check_info"]
+    # 检查构建文件；临时错误只影响本次结果（视为不满足），不会被缓存
+    try:
+        has_build, build_name = commit_has_build_file(full, sha, token=token)
+    except requests.RequestException:
+        has_build, build_name = False, None
+    # 检查 CI/checks 状态
+    try:
+        check_ok, check_info = commit_check_status_success(full, sha, token=token)
+    except requests.RequestException:
+        check_ok, check_info = False, None
+    return has_build, build_name, check_ok, check_info
+
+def pick_best_commit(full, commits, meta=None, token=None):
+    """
+    便宜的探测优先：按顺序查看各 commit 的构建文件与 checks 状态，返回第一个两者都满足的
+    (commit, probe)；都不满足时返回最后一个 commit。只有选中的 commit 才需要再取完整详情（patch）
+    """
+    # 各 commit 的探测互相独立：提交到 commit 线程池并行执行，按原顺序取结果
+    if COMMIT_EXECUTOR is not None:
+        futures = [COMMIT_EXECUTOR.submit(probe_commit, full, c.get("sha"), meta, token) for c in commits]
+        probes = (f.result() for f in futures)
+    else:
+        futures = []
+        probes = (probe_commit(full, c.get("sha"), meta, token) for c in commits)
+    best = None
+    for c, probe in zip(commits, probes):
+        best = (c, probe)
+        if probe[0] and probe[2]:
+            break
+    for f in futures:
+        f.cancel()
+    return best
+
+PATCH_TRUNCATED_MARK = "\n... [truncated]"
+
+def write_patch(files, out, max_bytes=0):
+    """
+    将 files[].patch 逐个写入 out（文本流），文件之间以空行分隔；
+    写入量超过 max_bytes（UTF-8 字节，0 表示不限制）时截断并追加 PATCH_TRUNCATED_MARK。
+    返回是否写入了内容
+    """
+    size = 0
+    for f in files:
+        p = f.get("patch")
+        if not p:
+            continue
+        sep = "\n\n" if size else ""
+        part = f"{sep}--- a/{f.get('filename')}\n+++ b/{f.get('filename')}\n{p}"
+        data = part.encode("utf-8")
+        if max_bytes and size + len(data) > max_bytes:
+            out.write(data[:max_bytes - size].decode("utf-8", "ignore"))
+            out.write(PATCH_TRUNCATED_MARK)
+            return True
+        out.write(part)
+        size += len(data)
+    return size > 0
+
+def process_commit(full, commit, probe, token=None, max_patch_bytes=MAX_PATCH_BYTES, patches_dir=None,
+                   no_patch=False, meta=None):
+    """
+    获取选中 commit 的详情（message / date / patch），与 probe 结果合并为 record 中 commit 部分的字段；
+    详情获取失败时 patch 为空，message 使用引用来源中的文本。
+    指定 patches_dir 时完整 patch 写入 {patches_dir}/{owner}_{repo}_{sha}.patch，record 中只保存文件名
+    （相对 patches_dir，不受输出位置与当前目录影响）；
+    no_patch 时只取不含 diff 的 git commit 对象，patch 为空；meta（fetch_commits_graphql 的结果）中已有
+    message / date 时直接使用，不再请求
+    """
+    sha = commit.get("sha")
+    m = (meta or {}).get((full, sha))
+    try:
+        if no_patch and m:
+            cd = {"commit": {"message": m["message"], "committer": {"date": m["date"]}}}
+        elif no_patch:
+            # git commit 对象与 commit 详情中的 "commit" 字段结构相同
+            cd = {"commit": get_git_commit(full, sha, token=token)}
+        else:
+            cd = get_commit_details(full, sha, token=token)
+    except Exception:
+        cd = {}
+    commit_msg = cd.get("commit", {}).get("message") or commit.get("message")
+    commit_date = cd.get("commit", {}).get("committer", {}).get("date") or cd.get("commit", {}).get("author", {}).get("date")
+    # 拼 patch（files 中的 patch 字段）
+    files = cd.get("files", [])
+    if no_patch or not files:
+        # 没有 diff 可写（--no-patch 或详情获取失败）：不创建 sidecar 文件
+        patch_text = None
+    elif patches_dir:
+        name = f"{full.replace('/', '_')}_{sha}.patch"
+        path = os.path.join(patches_dir, name)
+        with open(path, "w", encoding="utf-8") as pf:
+            wrote = write_patch(files, pf)
+        if not wrote:
+            os.remove(path)
+        patch_text = name if wrote else None
+    else:
+        buf = io.StringIO()
+        patch_text = buf.getvalue() if write_patch(files, buf, max_patch_bytes) else None
+    has_build, build_name, check_ok, check_info = probe
+    return {
+        "commit_sha": sha,
+        "commit_message": commit_msg,
+        "commit_date": commit_date,
+        "patch": patch_text,
+        "commit_has_build_file": has_build,
+        "commit_build_file_name": build_name,
+        "commit_check_success": check_ok,
+        "commit_check_info": check_info
+    }
+
+def process_issue(full, iss, index=None, token=None, max_patch_bytes=MAX_PATCH_BYTES, patches_dir=None,
+                  no_patch=False, meta=None):
+    """
+    处理单个 issue：查找引用它的 commits，选出最合适的一个并取详情，返回该 issue 产生的 record 列表。
+    index 为 build_issue_commit_index 的结果；索引中没有时查询 issue timeline（core 限额），
+    timeline 请求失败时才回退到逐 issue 的 search 请求。
+    meta 为 prepare_repo 按仓库批量获取的 commit 元信息，不在其中的 commit 才在这里单独查询
+    """
+    records = []
+    n = normalize_issue_item(iss, full)
+    # 找引用该 issue 的 commits / PRs
+    commits = index.get(n["issue_number"], []) if index is not None else []
+    if not commits:
+        try:
+            commits = get_issue_timeline(full, n["issue_number"], token=token, max_results=MAX_COMMITS_PER_ISSUE)
+        except requests.RequestException:
+            commits = find_commits_referencing_issue(full, n["issue_number"], token=token, max_results=MAX_COMMITS_PER_ISSUE)
+    if not commits:
+        # 这里保守地记录 issue 但不附带 commit
+        rec = {**n, **{
+            "commit_sha": None,
+            "commit_message": None,
+            "commit_date": None,
+            "patch": None,
+            "commit_has_build_file": False,
+            "commit_build_file_name": None,
+            "commit_check_success": False,
+            "commit_check_info": None
+        }}
+        records.append(rec)
+        return records
+    # 有 token 时用一次 GraphQL 请求补齐仓库批量结果中没有的 commit（来自 timeline / search）；失败时回退到 REST
+    meta = meta or {}
+    missing = [(full, c["sha"]) for c in commits if (full, c["sha"]) not in meta]
+    if missing and has_auth_token():
+        try:
+            meta = {**meta, **fetch_commits_graphql(missing, token=token)}
+        except Exception:
+            pass
+    # 先做便宜的构建文件 / checks 探测选出一个 commit，只为它取完整详情与 patch
+    commit, probe = pick_best_commit(full, commits, meta, token=token)
+    records.append({**n, **process_commit(full, commit, probe, token=token, max_patch_bytes=max_patch_bytes,
+                                          patches_dir=patches_dir, no_patch=no_patch, meta=meta)})
+    return records
 
-def save_csv(rows, path, fieldnames):
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames, quoting=csv.QUOTE_ALL)
-        w.writeheader()
-        for r in rows:
-            w.writerow(r)
-    print(f"[saved] {path}")
+def prepare_repo(full, q_extra, cutoff, max_issues, done=(), token=None):
+    """
+    每个仓库的准备工作（在线程池中执行）：搜索满足条件且尚未处理的 issue，建立 issue -> commit 索引，
+    有 token 时再用 GraphQL 按 GRAPHQL_BATCH_SIZE 个一批获取这些 issue 在索引中全部 commit 的元信息。
+    返回 (full, issues, index, meta)；索引建立失败时 index 为 None，由 process_issue 逐个 issue 查询
+    """
+    issues = search_issues_for_repo(full, q_extra, max_issues=max_issues, token=token)
+    issues = [iss for iss in issues if "pull_request" not in iss and (full, iss.get("number")) not in done]
+    if not issues:
+        return full, issues, None, {}
+    # 每个仓库只建一次 issue -> commit 索引，所有 issue 从内存中查找
+    try:
+        index = build_issue_commit_index(full, cutoff, token=token)
+    except requests.RequestException:
+        index = None
+    meta = {}
+    if index and has_auth_token():
+        pairs = [(full, c["sha"]) for iss in issues for c in index.get(iss.get("number"), [])]
+        try:
+            meta = fetch_commits_graphql(pairs, token=token)
+        except Exception:
+            meta = {}
+    return full, issues, index, meta
 
 def main():
+    global COMMIT_EXECUTOR
     ap = argparse.ArgumentParser(description="GitHub Java bug collector (issues -> commits/patches)")
-    ap.add_argument("--out-json", default="issues_commits.json")
-    ap.add_argument("--out-csv", default="issues_commits.csv")
-    ap.add_argument("--token", default=None, help="GitHub token (or set GITHUB_TOKEN env var)")
+    ap.add_argument("--out-json", default="issues_commits.jsonl", help="输出 JSONL（每行一条 record，边抓边写）")
+    ap.add_argument("--out-csv", default=None,
+                    help="表格输出路径（格式由 --out-format 决定，默认 issues_commits.<format>）")
+    ap.add_argument("--out-format", choices=("csv", "tsv", "parquet"), default="csv",
+                    help="表格输出格式：csv（QUOTE_ALL）、tsv（不加引号，文本列中的换行/制表符转义）或 parquet（需要 pyarrow）")
+    ap.add_argument("--token", default=None,
+                    help="GitHub token，可用逗号分隔多个以轮换额度 (or set GITHUB_TOKENS / GITHUB_TOKEN env var)")
     ap.add_argument("--cutoff", default=DEFAULT_CUTOFF,
                     help="只抓取 created_at >= cutoff 的 issues (YYYY-MM-DD)")
     ap.add_argument("--max-repos", type=int, default=100)
     ap.add_argument("--max-issues-per-repo", type=int, default=20)
+    ap.add_argument("--issue-query-extra", default=DEFAULT_ISSUE_QUERY,
+                    help="issue 搜索的附加条件（会自动追加 created:>=cutoff）")
+    ap.add_argument("--workers", type=int, default=MAX_WORKERS,
+                    help="并发线程数（issue 级与 commit 级线程池各使用该数量）")
+    ap.add_argument("--max-patch-bytes", type=int, default=MAX_PATCH_BYTES,
+                    help="record 中 patch 的最大字节数，超出截断（0 表示不限制）")
+    ap.add_argument("--patches-dir", default=None,
+                    help="将完整 patch 写入该目录（{owner}_{repo}_{sha}.patch），输出的 patch 列只保存该目录下的文件名")
+    ap.add_argument("--no-patch", action="store_true",
+                    help="不下载 commit diff，只取 message / date 及构建、CI 信息（patch 列为空）")
+    ap.add_argument("--resume", action="store_true",
+                    help="读取已有 --out-json，跳过已处理的 (repo, issue) 并追加写入；表格输出按 JSONL 重新生成")
+    ap.add_argument("--cache", nargs="?", const=DEFAULT_CACHE_PATH, default=None,
+                    help=f"启用 ETag 条件请求缓存，可指定 sqlite 路径（默认 {DEFAULT_CACHE_PATH}）；"
+                         f"不加该参数时不使用缓存，超过 {CACHE_MAX_AGE_DAYS} 天的条目在启动时删除")
     args, _unknown = ap.parse_known_args()   # use parse_known_args for Jupyter compatibility
+    args.out_csv = args.out_csv or f"issues_commits.{args.out_format}"
+    if args.out_format == "parquet":
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            ap.error("--out-format parquet 需要安装 pyarrow: pip install pyarrow")
 
-    token = args.token or os.getenv("GITHUB_TOKEN")
+    tokens = parse_tokens(args.token)
+    init_token_pool(tokens)
+    init_http_cache(args.cache)
+    print(f"[info] using {len(tokens) if tokens != [None] else 0} GitHub token(s).")
     cutoff = dateparser.parse(args.cutoff).date()
+    if args.patches_dir:
+        os.makedirs(args.patches_dir, exist_ok=True)
 
-    repos = search_repos_language_java(per_page=REPOS_PER_PAGE, max_repos=args.max_repos, token=token)
+    repos = search_repos_language_java(max_repos=args.max_repos)
     print(f"[info] fetched {len(repos)} java repos (top by stars).")
 
-    all_records = []
-    for repo in tqdm(repos, desc="repos"):
-        full = repo.get("full_name")
-        # 搜索该 repo 中 label:bug 且 created >= cutoff
-        q_extra = f'is:issue label:bug created:>={cutoff.isoformat()}'
-        issues = search_issues_for_repo(full, q_extra, per_page=100, max_issues=args.max_issues_per_repo, token=token)
-        if not issues:
-            continue
-        for iss in issues:
-            if "pull_request" in iss:
-                continue
-            n = normalize_issue_item(iss, full)
-            # 找引用该 issue 的 commits / PRs
-            commits = find_commits_referencing_issue(full, n["issue_number"], token=token, max_results=MAX_COMMITS_PER_ISSUE)
-            if not commits:
-                # 尝试使用 issue timeline (高级)，或者跳过
-                # 这里保守地记录 issue 但不附带 commit
-                rec = {**n, **{
-                    "commit_sha": None,
-                    "commit_message": None,
-                    "commit_date": None,
-                    "patch": None,
-                    "commit_has_build_file": False,
-                    "commit_build_file_name": None,
-                    "commit_check_success": False,
-                    "commit_check_info": None
-                }}
-                all_records.append(rec)
-                continue
-            # 逐个 commit 取详细信息（到达第一个满足可运行条件的也会记录）
-            recorded = False
-            for c in commits:
-                sha = c.get("sha")
-                try:
-                    cd = get_commit_details(full, sha, token=token)
-                except Exception:
-                    continue
-                commit_msg = cd.get("commit", {}).get("message")
-                commit_date = cd.get("commit", {}).get("committer", {}).get("date") or cd.get("commit", {}).get("author", {}).get("date")
-                # 拼 patch（files 中的 patch 字段）
-                patch_parts = []
-                for f in cd.get("files", []):
-                    p = f.get("patch")
-                    if p:
-                        header = f"--- a/{f.get('filename')}\n+++ b/{f.get('filename')}\n"
-                        patch_parts.append(header + p)
-                patch_text = "\n\n".join(patch_parts) if patch_parts else None
-                # 检查构建文件
-                has_build, build_name = commit_has_build_file(full, sha, token=token)
-                # 检查 CI/checks 状态
-                check_ok, check_info = commit_check_status_success(full, sha, token=token)
-
-                rec = {**n, **{
-                    "commit_sha": sha,
-                    "commit_message": commit_msg,
-                    "commit_date": commit_date,
-                    "patch": patch_text,
-                    "commit_has_build_file": has_build,
-                    "commit_build_file_name": build_name,
-                    "commit_check_success": check_ok,
-                    "commit_check_info": check_info
-                }}
-                all_records.append(rec)
-                # 若满足任一可运行近似（有 build file 且 check success），可以提前跳出 commits loop（可选）
-                if has_build and check_ok:
-                    recorded = True
-                    break
-            # end commits loop
-        # end issues loop
-    # end repos loop
-
-    # 保存
-    save_json(all_records, args.out_json)
-    # CSV flatten（patch 可能很长，仍会写入）
-    fieldnames = ["repo_fullname","repo_url","issue_id","issue_number","issue_title","issue_body","issue_created_at","issue_updated_at",
-                  "issue_url","user_login","commit_sha","commit_message","commit_date","commit_has_build_file","commit_build_file_name",
-                  "commit_check_success","commit_check_info","patch"]
-    save_csv(all_records, args.out_csv, fieldnames)
+    # 表格输出总是重新生成：--resume 时先写入 JSONL 中已有的 records
+    table = open_table_writer(args.out_csv, args.out_format)
+    done = load_done_issues(args.out_json, table) if args.resume else set()
+    if done:
+        print(f"[info] resume: skipping {len(done)} already processed issues.")
+
+    # 搜索每个 repo 中满足 --issue-query-extra 且 created >= cutoff 的 issue
+    q_extra = f'{args.issue_query_extra} created:>={cutoff.isoformat()}'
+
+    # 边抓边写：每个 issue 的 records 一产生就追加到 JSONL / 表格输出并 flush，
+    # 内存占用与输出总量无关，中断后可用 --resume 继续
+    n_records = 0
+    # JSONL 以二进制方式写入，直接写 orjson 输出的 bytes，省去一次 encode
+    with open(args.out_json, "ab" if args.resume else "wb") as jf, \
+            closing(table), tqdm(total=len(repos), desc="repos") as repo_bar, tqdm(desc="issues") as issue_bar:
+
+        def write_records(records):
+            nonlocal n_records
+            for rec in records:
+                jf.write(json_dumps_bytes(rec))
+                jf.write(b"\n")
+                table.writerow(rec)
+            jf.flush()
+            table.flush()
+            n_records += len(records)
+            issue_bar.update(1)
+
+        # 仓库准备（issue 搜索 + 建索引）、issue 处理、commit 级请求各用一个线程池，流水线式交错执行：
+        # 最多提前准备 --workers 个仓库，前面仓库的 issue 处理期间后面的仓库在建索引。
+        # commit 级请求使用独立的线程池，避免 issue 线程等待自身线程池造成死锁
+        with ThreadPoolExecutor(max_workers=args.workers) as repo_ex, \
+                ThreadPoolExecutor(max_workers=args.workers) as ex, \
+                ThreadPoolExecutor(max_workers=args.workers) as COMMIT_EXECUTOR:
+            repo_iter = iter(repos)
+            prepared = deque()
+
+            def submit_next_repo():
+                repo = next(repo_iter, None)
+                if repo is not None:
+                    prepared.append(repo_ex.submit(prepare_repo, repo.get("full_name"), q_extra, cutoff,
+                                                   args.max_issues_per_repo, done))
+
+            for _ in range(args.workers):
+                submit_next_repo()
+            # 在途的 issue futures，按 (repo, issue) 顺序写出，保持输出顺序稳定
+            pending = deque()
+            while prepared:
+                fut = prepared.popleft()
+                submit_next_repo()
+                while pending and pending[0].done():
+                    write_records(pending.popleft().result())
+                full, issues, index, meta = fut.result()
+                repo_bar.update(1)
+                for iss in issues:
+                    pending.append(ex.submit(process_issue, full, iss, index, max_patch_bytes=args.max_patch_bytes,
+                                             patches_dir=args.patches_dir, no_patch=args.no_patch, meta=meta))
+                    # 限制在途 issue 数，已完成但未写出的结果不会无限堆积
+                    while len(pending) > 2 * args.workers:
+                        write_records(pending.popleft().result())
+            while pending:
+                write_records(pending.popleft().result())
+        COMMIT_EXECUTOR = None
+    print(f"[saved] {n_records} records -> {args.out_json}, {args.out_csv}")
     print("[done]")
 
 if __name__ == "__main__":